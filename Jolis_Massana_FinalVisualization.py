@@ -1,58 +1,127 @@
+import hashlib
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import streamlit as st
+from streamlit import dataframe_util
+from streamlit.elements import vega_charts
 import pandas as pd
-import altair as alt
-alt.data_transformers.enable('vegafusion')
+from data_preparation import (
+    PREPARED_CACHE_DIR, file_content_hash, replace_file, store_dir, touch_store, prune_store, prepare_data, cube_rollup, expand_count_matrix,
+    build_state_attributes, build_lookup_tables, build_state_aggregates, build_population_table, per_capita_rates
+)
 
-from vega_datasets import data
-from itertools import product
+class LazyModule:
 
-def general_data_preparation(mass_shootings, county_population):
+    # stands for a module that is only imported on its first attribute access: sessions served from the
+    # shared specs (and headless uses of this file) never load Altair
+    def __init__(self, name):
+        self.name = name
 
-    mass_shootings['Latitude'] = pd.to_numeric(mass_shootings['Latitude'], errors='coerce')
-    mass_shootings['Longitude'] = pd.to_numeric(mass_shootings['Longitude'], errors='coerce')
+    def __getattr__(self, attribute):
+        return getattr(importlib.import_module(self.name), attribute)
 
-    mass_shootings['Incident Date'] = pd.to_datetime(mass_shootings['Incident Date'])
-    mass_shootings['Month,Year'] = mass_shootings['Incident Date'].dt.to_period('M').dt.to_timestamp()
-    mass_shootings['Year'] = mass_shootings['Month,Year'].apply(lambda x: x.year)
-    mass_shootings = mass_shootings.drop('Incident Date', axis=1)
- 
-    # grouping BY STATE AND MONTH
-    mass_shootings_states = mass_shootings.groupby(['State', 'State_Lon', 'State_Lat', 'Abbreviation', 'Month,Year', 'Year', 'FIPS', 'Region', 'Population']).size().reset_index(name='Total Shootings')
-    
-    # grouping BY REGION AND MONTH
-    mass_shootings_regions = mass_shootings.groupby(['Region', 'Month,Year', 'Year']).size().reset_index(name='Total Shootings')
-    region_population = mass_shootings_states.drop_duplicates('State').groupby(['Region'])['Population'].sum()
-    mass_shootings_regions = mass_shootings_regions.merge(region_population, on = 'Region')
+alt = LazyModule('altair')
 
-    dates = pd.date_range(start = '2014-01', end = '2023-12', freq = 'MS')
-    states = mass_shootings_states['State'].unique()
-    regions_states = mass_shootings_states[['Region', 'State']].drop_duplicates()
+# Streamlit serves the static/ folder (geometry in data_preparation.GEOMETRY_DIR) under app/static/ (.streamlit/config.toml)
+GEOMETRY_URL = 'app/static/geometry'
 
-    # crossing both lists to obtain a continuous dataframe with all dates-state pairs
-    date_state_combinations = list(product(dates, states))
+# above this many incidents the county scatter draws density cells of this size (in degrees) instead of points
+SCATTER_POINT_LIMIT = 20000
+SCATTER_CELL_DEGREES = 0.25
+# lightest charts first: built one after the other, they reach the page in this order
+DASHBOARD_CHARTS = ['second_question_slopechart', 'extra_question', 'first_and_third_question']
 
-    cont_mass_shootings_states = pd.DataFrame(date_state_combinations, columns = ['Month,Year', 'State'])
-    cont_mass_shootings_states['Month,Year'] = cont_mass_shootings_states['Month,Year'].dt.to_period('M').dt.to_timestamp()
-    cont_mass_shootings_states = cont_mass_shootings_states.merge(regions_states, on = ['State'], how = 'inner')
+# worker processes building the charts of a cold store in parallel (opt-in: below 2 they are built one after the other)
+BUILD_WORKERS = int(os.environ.get('DASHBOARD_BUILD_WORKERS', '0'))
 
-    mass_shootings_states = cont_mass_shootings_states.merge(mass_shootings_states, on = ['Month,Year', 'State', 'Region'], how = 'left')
-    mass_shootings_states['Total Shootings'] = mass_shootings_states['Total Shootings'].fillna(0)
-    mass_shootings_states['FIPS'] = pd.to_numeric(mass_shootings_states['FIPS'], errors='coerce')
+# chart specs of every version of this file, in the store of the prepared data
+CHART_STORE_PATTERN = re.compile(r'charts-[0-9a-f]{16}')
 
-    # preparation of conty population
-    missing_counties = pd.DataFrame([
-        {'County FIPS': 2201, 'County Name': 'Prince of Wales-Outer Ketchikan, AK', 'County Population': 5696},
-        {'County FIPS': 2232, 'County Name': 'Skagway-Hoonah-Angoon, AK', 'County Population': 2262},
-        {'County FIPS': 2261, 'County Name': 'Valdez-Cordova, AK', 'County Population': 9202},
-        {'County FIPS': 2270, 'County Name': 'Wade Hampton, AK', 'County Population': 8001},
-        {'County FIPS': 2280, 'County Name': 'Wrangell-Petersburg, AK', 'County Population': 2064},
-        {'County FIPS': 46113, 'County Name': 'Shannon County, SD', 'County Population': 13672},
-        {'County FIPS': 51515, 'County Name': 'Bedford, VA', 'County Population': 6777},
-    ])
-    county_population = pd.concat([county_population, missing_counties], ignore_index=True)
-    county_population = county_population[county_population['County FIPS']%1000 != 0] # erasing State FIPS
-    
-    return mass_shootings, mass_shootings_regions, mass_shootings_states, county_population
+# charts exported ahead of time by build_artifacts.py, served instead of building them when built for the same inputs
+
+ARTIFACTS_DIR = os.environ.get('DASHBOARD_ARTIFACTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dist'))
+
+# Altair's data transformer and theme are global to the process: the conversions of this file switch them
+# under the lock st.altair_chart takes for the same reason, so that charts converted in the background and
+# live charts of a session never see each other's settings
+ALTAIR_GLOBALS_LOCK = getattr(vega_charts, '_altair_globals_lock', threading.Lock())
+
+# chart profiles (a live build of every chart) are logged as one JSON object per line: DASHBOARD_PROFILE=1 profiles
+# every run, DASHBOARD_PROFILE=debug only the runs of ?debug=1 (also shown in the sidebar). The query parameter is
+# ignored otherwise, so that no visitor can make the server rebuild every chart on each run
+PROFILE_MODE = os.environ.get('DASHBOARD_PROFILE', '')
+profile_logger = logging.getLogger('dashboard.profile')
+
+@st.cache_resource(show_spinner = False)
+def hash_input_file(path, modified_ns, size):
+
+    return file_content_hash(path)
+
+
+
+def input_file_hash(path):
+
+    # the content hash of an input is only computed again when its modification time or size change, not on
+    # every run of every session (the inputs are hundreds of MB at the larger scales)
+    stat = os.stat(path)
+
+    return hash_input_file(path, stat.st_mtime_ns, stat.st_size)
+
+
+
+@st.cache_resource(show_spinner = False)
+def load_prepared_data(
+mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash):
+
+    # the content hashes are only part of the cache key: the prepared frames are shared by all sessions
+    # and only rebuilt when one of the input files actually changes (see data_preparation.prepare_data).
+    # The frames are a cached resource (one object per process, not a copy per session): they are read-only
+    return prepare_data(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash)
+
+
+
+@st.cache_resource(show_spinner = False)
+def load_population_table(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash):
+
+    mass_shootings, _, _, county_population, _ = load_prepared_data(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash)
+
+    return build_population_table(mass_shootings, county_population)
+
+
+
+@st.cache_resource(show_spinner = False)
+def load_rates(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash, level, grain = None):
+
+    # memoized per level and time grain: every chart normalizing by population shares the same joins
+    aggregation_cube = load_prepared_data(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash)[-1]
+    population_table = load_population_table(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash)
+
+    return per_capita_rates(aggregation_cube, population_table, level, grain)
+
+
+
+@st.cache_resource(show_spinner = False)
+def load_chart_tables(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash):
+
+    # lookup tables, pre-aggregations and rates only depend on the prepared frames, so they share their cache key
+    mass_shootings, _, _, county_population, _ = load_prepared_data(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash)
+    region_year_rates = load_rates(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash, 'region', 'year')
+
+    return build_lookup_tables(mass_shootings, county_population), build_state_aggregates(mass_shootings), region_year_rates
+
+
+
+def load_geometry(feature, detail = 'medium', geometry_url = GEOMETRY_URL):
+
+    # the browser fetches the local static route (and caches it), or the folder next to the static export
+    return alt.topo_feature(f'{geometry_url}/us-{feature}-{detail}.json', feature)
 
 
 
@@ -110,7 +179,7 @@ def Q1_line_chart_regions(mass_shootings_regions, region_selection, date_selecti
 
 
 
-def Q1_region_state_charts(mass_shootings_states, region_selection, state_selection, date_selection):
+def Q1_region_state_charts(mass_shootings_states, state_lookup, region_selection, state_selection, date_selection, geometry_url = GEOMETRY_URL):
 
     color_west = ['#6f0036', '#68028b', '#920597', '#9c4088','#b20258', '#a80686', '#bd02f3', '#d3088c', '#e80576', '#dc09e3', '#f967ae']
     color_midwest = ['#66550e', '#ca1a00', '#9a5204', '#c35400', '#b06900', '#fd472c','#eb6601', '#d48105', '#fd682c', '#ed7f07', '#ff8857', '#f6a123']
@@ -132,14 +201,14 @@ def Q1_region_state_charts(mass_shootings_states, region_selection, state_select
         'Southeast': color_params_seast
     }
     
-    USA_states = alt.topo_feature(data.us_10m.url, 'states')
+    USA_states = load_geometry('states', 'low', geometry_url)
     all_state_linecharts, all_state_choropleths = list(), list()
 
     #--------------- STATE CHOROPLETH PLOTTING ---------------#
    
     base_choropleth = alt.Chart(USA_states).mark_geoshape().transform_lookup(
         lookup = 'id',
-        from_ = alt.LookupData(mass_shootings_states, 'FIPS', ['Region', 'State'])
+        from_ = alt.LookupData(state_lookup, 'FIPS', ['Region', 'State'])
     ).properties(
         width = 550,
         height = 250,
@@ -200,18 +269,23 @@ def Q1_region_state_charts(mass_shootings_states, region_selection, state_select
 
 
 
-def first_and_third_question(mass_shootings_regions, mass_shootings_states, mass_shootings, county_population):
+def first_and_third_question(mass_shootings_regions, state_month_counts, mass_shootings, county_population, aggregation_cube, state_lookup, state_aggregates = None, geometry_url = GEOMETRY_URL):
 
-    mass_shootings_regions = mass_shootings_regions.groupby(['Region', 'Month,Year', 'Year'])['Total Shootings'].sum().reset_index()
-    mass_shootings_states = mass_shootings_states.groupby(['State', 'State_Lon', 'State_Lat', 'Abbreviation', 'Region', 'Month,Year', 'Year','FIPS'])['Total Shootings'].sum().reset_index()
+    # region-month counts are already one row per region and month, the states x months matrix is only
+    # expanded to one row per state and month (with the state attributes) here, for the charts
+    mass_shootings_regions = mass_shootings_regions[['Region', 'Month,Year', 'Year', 'Total Shootings']]
+    mass_shootings_states = expand_count_matrix(state_month_counts, build_state_attributes(mass_shootings))
+    mass_shootings_states['FIPS'] = pd.to_numeric(mass_shootings_states['FIPS'], errors='coerce')
+    mass_shootings_states = mass_shootings_states[['State', 'State_Lon', 'State_Lat', 'Abbreviation', 'Region', 'Month,Year', 'Year', 'FIPS', 'Total Shootings']]
 
-    mass_shootings['State_City_Combo'] = mass_shootings['City Or County'] + ' - ' + mass_shootings['State']
-    mass_shootings_counties = mass_shootings.groupby(['State_City_Combo', 'Region', 'State']).size().reset_index(name='Total Shootings').sort_values(by='State_City_Combo', ascending=False)
-    mass_shootings_counties['Rank in State'] = mass_shootings_counties.groupby('State')['Total Shootings'].rank(ascending=False, method='first').astype(int)
-    top3_counties = mass_shootings_counties[mass_shootings_counties['Rank in State'] <= 3]['State_City_Combo']
+    # incidents are counted by the county they are located in (see assign_incident_counties), not by their city or county label
+    mass_shootings_counties = cube_rollup(aggregation_cube, ['County FIPS', 'Region', 'State']).sort_values(by='County FIPS', ascending=False)
+    mass_shootings_counties['Rank in State'] = mass_shootings_counties.groupby('State', observed = True)['Total Shootings'].rank(ascending=False, method='first').astype(int)
+    top3_counties = mass_shootings_counties.loc[mass_shootings_counties['Rank in State'] <= 3, ['County FIPS', 'State']]
 
-    mass_shootings_top3_counties = mass_shootings.groupby(['State_City_Combo', 'City Or County', 'State', 'Region', 'Month,Year']).size().reset_index(name='Total Shootings')
-    mass_shootings_top3_counties = mass_shootings_top3_counties.merge(top3_counties, on=['State_City_Combo'], how='inner')
+    mass_shootings_top3_counties = cube_rollup(aggregation_cube, ['County FIPS', 'State', 'Region'], 'month')
+    mass_shootings_top3_counties = mass_shootings_top3_counties.merge(top3_counties, on=['County FIPS', 'State'], how='inner')
+    mass_shootings_top3_counties = mass_shootings_top3_counties.merge(county_population[['County FIPS', 'County Name']].drop_duplicates('County FIPS'), on=['County FIPS'], how='left')
     
     # 3-color palette per region for the county line charts --> 3 counties = 3 colors
     region_palette = {
@@ -221,14 +295,21 @@ def first_and_third_question(mass_shootings_regions, mass_shootings_states, mass
         'Northeast': ['#3597e1', '#41a0c0', '#2b8ed5'], # light blue shades
         'Southeast': ['#4bb04b', '#1d770d', '#207e48'],  # green shades
     }
-    mass_shootings_top3_counties['Color Palette'] = mass_shootings_top3_counties['Region'].map(region_palette)
+    mass_shootings_top3_counties['Color Palette'] = mass_shootings_top3_counties['Region'].astype(str).map(region_palette)
+
+    # each county takes the palette colour of its alphabetical position among the top 3 of its state,
+    # so a single chart can draw every state with its region palette (colour field used with scale = None)
+    county_names = mass_shootings_top3_counties['County Name'].astype(str)
+    county_position = county_names.groupby(mass_shootings_top3_counties['State'], observed = True).rank(method = 'dense').astype(int) - 1
+    mass_shootings_top3_counties['County Color'] = [palette[position].strip() for palette, position in zip(mass_shootings_top3_counties['Color Palette'], county_position)]
+    mass_shootings_top3_counties = mass_shootings_top3_counties.drop(['Color Palette', 'County FIPS'], axis=1)
     
 
     # defining the interactive selections
     state_selection = alt.selection_point(fields=['State'], name='state_select')
     region_selection = alt.selection_point(fields = ['Region'], name='region_select')
     date_selection = alt.selection_interval(encodings=['x'])
-    county_selection = alt.selection_point(fields = ['City Or County'])
+    county_selection = alt.selection_point(fields = ['County Name'])
 
     color_palette = ['#E69F00', '#56B4E9', '#009E73', '#0072B2', '#CC79A7']
     region_order = sorted(mass_shootings_regions['Region'].unique())
@@ -240,11 +321,11 @@ def first_and_third_question(mass_shootings_regions, mass_shootings_states, mass
 
     #--------------- REGION CHOROPLETH PLOTTING ---------------#
 
-    USA_states = alt.topo_feature(data.us_10m.url, 'states')
+    USA_states = load_geometry('states', 'low', geometry_url)
 
     region_choropleth = alt.Chart(USA_states).transform_lookup(
         lookup = 'id',
-        from_ = alt.LookupData(mass_shootings_states, 'FIPS', ['Region', 'State'])
+        from_ = alt.LookupData(state_lookup, 'FIPS', ['Region', 'State'])
     ).mark_geoshape(stroke = 'darkgray').encode(
         color=color_region,
         tooltip = ['Region:N', 'State:N']
@@ -256,12 +337,21 @@ def first_and_third_question(mass_shootings_regions, mass_shootings_states, mass
         height = 250
     ).project(type = 'albersUsa')
 
-    total_mass_shootings = alt.Chart(mass_shootings).transform_aggregate(
-        latitude = 'mean(Latitude)',
-        longitude = 'mean(Longitude)',  
-        count = 'count()',
-        groupby = ['State']
-    ).mark_circle().encode(
+    # with state_aggregates (pre-aggregation mode) only the 50 per-state rows are sent, otherwise
+    # every incident is sent and aggregated client-side
+    if state_aggregates is None:
+        total_mass_shootings = alt.Chart(mass_shootings).transform_aggregate(
+            latitude = 'mean(Latitude)',
+            longitude = 'mean(Longitude)',  
+            count = 'count()',
+            groupby = ['State']
+        )
+        state_labels = mass_shootings_states
+    else:
+        state_bubbles, state_labels = state_aggregates
+        total_mass_shootings = alt.Chart(state_bubbles)
+
+    total_mass_shootings = total_mass_shootings.mark_circle().encode(
         longitude = 'longitude:Q',
         latitude = 'latitude:Q',
         size = alt.Size('count:Q', legend = None),
@@ -276,7 +366,7 @@ def first_and_third_question(mass_shootings_regions, mass_shootings_states, mass
 
     #--------------- STATE LINE CHART PLOTTING ---------------#    
 
-    state_linecharts, state_choropleths = Q1_region_state_charts(mass_shootings_states, region_selection, state_selection, date_selection)
+    state_linecharts, state_choropleths = Q1_region_state_charts(mass_shootings_states, state_lookup, region_selection, state_selection, date_selection, geometry_url)
     
     final_state_linechart = alt.layer(*state_linecharts).resolve_scale(color = 'independent')
 
@@ -284,7 +374,7 @@ def first_and_third_question(mass_shootings_regions, mass_shootings_states, mass
 
     final_state_choropleth = alt.layer(*state_choropleths).resolve_scale(color = 'independent')
     
-    state_abbreviations = alt.Chart(mass_shootings_states).mark_text().encode(
+    state_abbreviations = alt.Chart(state_labels).mark_text().encode(
         longitude = 'State_Lon:Q',
         latitude = 'State_Lat:Q',
         color = alt.value('white'),
@@ -295,63 +385,53 @@ def first_and_third_question(mass_shootings_regions, mass_shootings_states, mass
 
     #--------------- TOP 3 COUNTY LINE CHART PLOTTING ---------------#
 
-    county_linecharts = list()
     y_domain = [0, mass_shootings_top3_counties['Total Shootings'].max()]
     opacity_county = alt.condition(county_selection, alt.value(1), alt.value(0.3))
+    color_county = alt.condition(county_selection, alt.Color('County Color:N', scale = None), alt.value('lightgray'))
 
-    for state_name in mass_shootings_states['State'].unique(): 
-
-        background_top3_counties = alt.Chart(mass_shootings_top3_counties).mark_line(point = True, opacity = 0.3).encode(
-            alt.X('Month,Year:T', axis = alt.Axis(title = 'Date', format = '%b %Y', labelAngle = -45, titleColor = 'black', labelColor = 'black', titleFontSize = 14, labelFontSize = 12)).scale(domain = date_selection),
-            alt.Y('Total Shootings:Q',axis = alt.Axis(titleColor = 'black', labelColor = 'black', titleFontSize = 14, labelFontSize = 12), scale=alt.Scale(domain=y_domain)),
-            color = alt.condition(county_selection, alt.Color(
-                'City Or County:N',  
-                scale = alt.Scale(range = mass_shootings_top3_counties[mass_shootings_top3_counties['State'] == state_name]['Color Palette'].iloc[0]),
-                legend = None
-            ),alt.value('lightgray'))
-        ).properties(
-            width = 700,
-            height = 300,
-            title = alt.TitleParams(text = 'Top 3 Counties By Mass Shootings in the Selected State (2014-2024)', fontSize = 18, color = 'black', fontWeight='bold') 
-        ).add_params(
-            county_selection
-        ).transform_filter(
-            state_selection
-        ).transform_filter(
-            region_selection
-        ).transform_filter(
-            date_selection
-        )
-
-        highlighted_top3_counties = alt.Chart(mass_shootings_top3_counties).mark_line(point = True, size = 2).encode(
-            alt.X('Month,Year:T'),
-            alt.Y('Total Shootings:Q'),
-            color = alt.condition(county_selection, alt.Color(
-                'City Or County:N',  
-                scale = alt.Scale(range = mass_shootings_top3_counties[mass_shootings_top3_counties['State'] == state_name]['Color Palette'].iloc[0]),
-                legend = None
-            ),alt.value('lightgray')),
-            opacity = opacity_county,
-            tooltip = ['Total Shootings:Q', 'City Or County:N', 'State:N','Region:N', 'Month,Year:T']
-        ).properties(
-            width = 700,
-            height = 300,
-            title = alt.TitleParams(text = 'Top 3 counties by mass shootings in the selected state (2014-2024)', fontSize = 18, color = 'black', fontWeight='bold') 
-        ).transform_filter(
-            county_selection
-        ).transform_filter(
-            state_selection
-        ).transform_filter(
-            region_selection
-        ).transform_filter(
-            date_selection
-        )
+    background_top3_counties = alt.Chart(mass_shootings_top3_counties).mark_line(point = True, opacity = 0.3).encode(
+        alt.X('Month,Year:T', axis = alt.Axis(title = 'Date', format = '%b %Y', labelAngle = -45, titleColor = 'black', labelColor = 'black', titleFontSize = 14, labelFontSize = 12)).scale(domain = date_selection),
+        alt.Y('Total Shootings:Q',axis = alt.Axis(titleColor = 'black', labelColor = 'black', titleFontSize = 14, labelFontSize = 12), scale=alt.Scale(domain=y_domain)),
+        detail = 'State:N',
+        color = color_county
+    ).properties(
+        width = 700,
+        height = 300,
+        title = alt.TitleParams(text = 'Top 3 Counties By Mass Shootings in the Selected State (2014-2024)', fontSize = 18, color = 'black', fontWeight='bold') 
+    ).add_params(
+        county_selection
+    ).transform_filter(
+        state_selection
+    ).transform_filter(
+        region_selection
+    ).transform_filter(
+        date_selection
+    )
 
-        county_linecharts.append(alt.layer(background_top3_counties, highlighted_top3_counties).transform_filter(alt.datum.State == state_name).encode(
-            alt.X('Month,Year:T', axis=alt.Axis(title = 'Date', format='%b %Y', labelAngle=-45, titleColor = 'black', labelColor = 'black', titleFontSize = 14, labelFontSize = 12)))
-        )
+    highlighted_top3_counties = alt.Chart(mass_shootings_top3_counties).mark_line(point = True, size = 2).encode(
+        alt.X('Month,Year:T'),
+        alt.Y('Total Shootings:Q'),
+        detail = 'State:N',
+        color = color_county,
+        opacity = opacity_county,
+        tooltip = ['Total Shootings:Q', 'County Name:N', 'State:N','Region:N', 'Month,Year:T']
+    ).properties(
+        width = 700,
+        height = 300,
+        title = alt.TitleParams(text = 'Top 3 counties by mass shootings in the selected state (2014-2024)', fontSize = 18, color = 'black', fontWeight='bold') 
+    ).transform_filter(
+        county_selection
+    ).transform_filter(
+        state_selection
+    ).transform_filter(
+        region_selection
+    ).transform_filter(
+        date_selection
+    )
 
-    final_county_linechart = alt.layer(*county_linecharts).resolve_scale(color = 'independent')
+    final_county_linechart = alt.layer(background_top3_counties, highlighted_top3_counties).encode(
+        alt.X('Month,Year:T', axis=alt.Axis(title = 'Date', format='%b %Y', labelAngle=-45, titleColor = 'black', labelColor = 'black', titleFontSize = 14, labelFontSize = 12))
+    )
 
 
 
@@ -368,39 +448,24 @@ def first_and_third_question(mass_shootings_regions, mass_shootings_states, mass
 
 
 
-def second_question_slopechart(mass_shootings_regions):
+def second_question_slopechart(region_year_rates):
     
     #--------------- DATA PREPARATION ---------------#
 
-    mass_shootings_regions = mass_shootings_regions.groupby(['Region', 'Year', 'Population'])['Total Shootings'].sum().reset_index()
-
-    # defining the proportion by population
-    mass_shootings_regions['Shootings per 10M citizens'] = mass_shootings_regions['Total Shootings'] / mass_shootings_regions['Population'] * 10**7
-    mass_shootings_regions = mass_shootings_regions.drop(['Population', 'Total Shootings'], axis=1)
+    # shootings per 10M citizens of every region and year (see per_capita_rates)
+    mass_shootings_regions = region_year_rates[['Region', 'Year', 'Shootings per 10M citizens']]
 
     # for the sake of correct slope chart plotting 
-    mass_shootings_regions['Comparison'] = mass_shootings_regions['Year'].apply(lambda x: '2014' if x == 2014 else 'Comparison Year')
-
-    mass_shootings_2014 = mass_shootings_regions[mass_shootings_regions['Year'] == 2014].drop(['Year', 'Comparison'], axis=1)
-    mass_shootings_regions = mass_shootings_regions[mass_shootings_regions['Year'] != 2014]
-
-    for region in mass_shootings_regions['Region'].unique():
-        for year in mass_shootings_regions['Year'].unique():
-            new_row = pd.DataFrame({
-                'Region': [region],
-                'Year': [year],
-                'Comparison': ['2014'],
-                'Shootings per 10M citizens': [mass_shootings_2014[mass_shootings_2014['Region'] == region]['Shootings per 10M citizens'].iloc[0]]
-            })
-        
-            mass_shootings_regions = pd.concat([mass_shootings_regions, new_row], ignore_index=True)
+    is_2014 = mass_shootings_regions['Year'] == 2014
+    mass_shootings_2014 = mass_shootings_regions.loc[is_2014, ['Region', 'Shootings per 10M citizens']]
+    mass_shootings_regions = mass_shootings_regions[~is_2014].assign(Comparison = 'Comparison Year')
 
-    # separating the dataset by regions for posterior plot juxtaposition
-    mass_shootings_midwest = mass_shootings_regions[mass_shootings_regions['Region'] == 'Midwest']
-    mass_shootings_northeast = mass_shootings_regions[mass_shootings_regions['Region'] == 'Northeast']
-    mass_shootings_southeast = mass_shootings_regions[mass_shootings_regions['Region'] == 'Southeast']
-    mass_shootings_southwest = mass_shootings_regions[mass_shootings_regions['Region'] == 'Southwest']
-    mass_shootings_west = mass_shootings_regions[mass_shootings_regions['Region'] == 'West']
+    # every (region, comparison year) pair starts its slope at the region's 2014 value
+    comparison_years = pd.DataFrame({'Year': mass_shootings_regions['Year'].unique()})
+    mass_shootings_2014 = mass_shootings_2014[mass_shootings_2014['Region'].isin(mass_shootings_regions['Region'])]
+    baseline_rows = mass_shootings_2014.merge(comparison_years, how = 'cross').assign(Comparison = '2014')
+
+    mass_shootings_regions = pd.concat([mass_shootings_regions, baseline_rows], ignore_index=True)
     
 
     #--------------- SLOPE CHART PLOTTING ---------------#
@@ -414,12 +479,9 @@ def second_question_slopechart(mass_shootings_regions):
     opacity = alt.condition(Q2_year_selection, alt.value(1), alt.value(0.2)) 
 
     slopecharts_regions = list()
-    region_dfs = [mass_shootings_midwest, mass_shootings_northeast, mass_shootings_southeast, mass_shootings_southwest, mass_shootings_west]
-    region_names = ['Midwest', 'Northeast', 'Southeast', 'Southwest', 'West']
 
-    for i in range(len(region_dfs)):
-        df = region_dfs[i]
-        region = region_names[i]
+    # separating the dataset by regions for posterior plot juxtaposition
+    for region, df in mass_shootings_regions.groupby('Region', observed = True):
 
         slopechart = alt.Chart(df).mark_line(point = True).encode(
             x = alt.X('Comparison:N', title = 'Time', 
@@ -457,12 +519,53 @@ def second_question_slopechart(mass_shootings_regions):
 
 
 
-def extra_question(mass_shootings, county_population, Qextra_year_selection):
+def incident_density_cells(incidents, cell_degrees):
+
+    # incidents of every year binned into a regular longitude/latitude grid, each cell drawn at the mean
+    # position of its incidents
+    cells = incidents.assign(
+        lon_cell = (incidents['Longitude'] // cell_degrees).astype('int32'),
+        lat_cell = (incidents['Latitude'] // cell_degrees).astype('int32')
+    )
+
+    return cells.groupby(['Year', 'lon_cell', 'lat_cell'], observed = True).agg(
+        Longitude = ('Longitude', 'mean'),
+        Latitude = ('Latitude', 'mean'),
+        Incidents = ('Longitude', 'size')
+    ).reset_index().drop(columns = ['lon_cell', 'lat_cell'])
+
+
+
+def extra_question(mass_shootings, state_lookup, county_lookup, Qextra_year_selection = None, geometry_url = GEOMETRY_URL):
 
     #--------------- DATA PREPARATION ---------------#
 
-    USA_counties = alt.topo_feature(data.us_10m.url, 'counties')
-    USA_states = alt.topo_feature(data.us_10m.url, 'states')
+    # without a fixed year, the year is a Vega param bound to a slider: the chart is built once
+    # and moving the slider only filters client-side, with no rerun nor new data from the server
+    year_param = None
+    if Qextra_year_selection is None:
+        year_param = alt.param(
+            name = 'Qextra_year',
+            value = int(mass_shootings['Year'].min()),
+            bind = alt.binding_range(min = int(mass_shootings['Year'].min()), max = int(mass_shootings['Year'].max()), step = 1, name = 'Date Year Selector: Analyze Mass Shooting Trends Over Time ')
+        )
+        Qextra_year_selection = year_param
+
+    # level of detail of the scatter: only the columns it draws, only the selected year when it is fixed, and
+    # density cells instead of single points when there are too many incidents to draw them interactively
+    incidents = mass_shootings[['Year', 'Longitude', 'Latitude']]
+    if year_param is None:
+        incidents = incidents[incidents['Year'] == Qextra_year_selection]
+    if len(incidents) > SCATTER_POINT_LIMIT:
+        incidents = incident_density_cells(incidents, SCATTER_CELL_DEGREES)
+        incident_size = alt.Size('Incidents:Q', scale = alt.Scale(range = [12, 300]), legend = None)
+        incident_tooltip = ['Incidents:Q']
+    else:
+        incident_size = alt.value(12)
+        incident_tooltip = alt.value(None)
+
+    USA_counties = load_geometry('counties', 'medium', geometry_url)
+    USA_states = load_geometry('states', 'low', geometry_url)
 
     domain = [2000, 100000, 1000000, 5000000, 10000000]
     color_range = ['#e0e0e0', '#b3b3b3', '#808080', '#4d4d4d', '#2d2d2d']
@@ -471,7 +574,7 @@ def extra_question(mass_shootings, county_population, Qextra_year_selection):
 
     state_shape_overlay = alt.Chart(USA_states).transform_lookup(
         lookup = 'id',
-        from_ = alt.LookupData(mass_shootings, 'FIPS', list(mass_shootings.columns))
+        from_ = alt.LookupData(state_lookup, 'FIPS', ['State'])
     ).mark_geoshape(
         stroke = 'black',
         fill = 'transparent'
@@ -482,7 +585,7 @@ def extra_question(mass_shootings, county_population, Qextra_year_selection):
     
     Qextra_county_population_map = alt.Chart(USA_counties).transform_lookup(
         lookup = 'id',
-        from_ = alt.LookupData(county_population, 'County FIPS', list(county_population.columns))
+        from_ = alt.LookupData(county_lookup, 'County FIPS', ['County Name', 'County Population'])
     ).mark_geoshape(
         stroke = 'darkgray',
         strokeWidth = 0.5,
@@ -501,48 +604,373 @@ def extra_question(mass_shootings, county_population, Qextra_year_selection):
         tooltip = ['County Name:N', 'County Population:Q']
     ).project(type = 'albersUsa')
     
-    Qextra_county_shootings = alt.Chart(mass_shootings).mark_circle().encode(
+    # the points of the other years are filtered out (not only hidden), so they are neither projected nor drawn
+    Qextra_county_shootings = alt.Chart(incidents).transform_filter(
+        alt.datum.Year == Qextra_year_selection
+    ).mark_circle().encode(
         longitude = 'Longitude:Q',
         latitude = 'Latitude:Q',
-        size = alt.value(12),
+        size = incident_size,
         color = alt.value('#003E5C'),
-        opacity = alt.condition(alt.datum.Year == Qextra_year_selection, alt.value(0.8), alt.value(0))
+        opacity = alt.value(0.8),
+        tooltip = incident_tooltip
     ).project(type = 'albersUsa')
        
     selected_county_overlay = alt.Chart(USA_counties).transform_lookup(
         lookup = 'id',
-        from_ = alt.LookupData(county_population, 'County FIPS', list(county_population.columns))
+        from_ = alt.LookupData(county_lookup, 'County FIPS', ['County Name'])
     ).mark_geoshape(fill = 'transparent').encode(
         tooltip = ['County Name:N']
     ).project(type = 'albersUsa')
 
 
     Qextra_choro_scatter_final = alt.layer(state_shape_overlay, Qextra_county_population_map, Qextra_county_shootings, selected_county_overlay).properties(height = 475)
+    if year_param is not None:
+        Qextra_choro_scatter_final = Qextra_choro_scatter_final.add_params(year_param)
     
     return Qextra_choro_scatter_final
 
 
+def count_chart_layers(chart):
+
+    for composition in ('layer', 'hconcat', 'vconcat', 'concat'):
+        subcharts = getattr(chart, composition, alt.Undefined)
+        if subcharts is not alt.Undefined:
+            return sum(count_chart_layers(subchart) for subchart in subcharts)
+
+    return 1
+
+
+
+def count_inline_rows(vega_spec):
+
+    # datasets can be declared at any level of nested group marks
+    rows = 0
+    for dataset in vega_spec.get('data', []):
+        if isinstance(dataset.get('values'), list):
+            rows += len(dataset['values'])
+    for mark in vega_spec.get('marks', []):
+        rows += count_inline_rows(mark)
+
+    return rows
+
+
+
+def profile_chart(chart_profiles, chart_name, build_function, *args):
+
+    # without a profile list the chart is only built. Otherwise it is also converted twice more than Streamlit
+    # needs: to the Vega-Lite spec with Arrow datasets Streamlit sends to the browser (the payload of the
+    # app), and to the Vega spec pre-transformed by VegaFusion (the payload of the static export, with its rows)
+    if chart_profiles is None:
+        return build_function(*args)
+
+    start = time.perf_counter()
+    chart = build_function(*args)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ALTAIR_GLOBALS_LOCK:
+        vega_spec = chart.to_dict(format = 'vega')
+    pre_transform_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vega_lite_bytes, arrow_bytes = shared_spec_bytes(chart_to_shared_spec(chart))
+    convert_seconds = time.perf_counter() - start
+
+    profile = {
+        'chart': chart_name,
+        'build_seconds': round(build_seconds, 4),
+        'convert_seconds': round(convert_seconds, 4),
+        'vega_lite_bytes': vega_lite_bytes,
+        'arrow_bytes': arrow_bytes,
+        'sent_bytes': vega_lite_bytes + arrow_bytes,
+        'pre_transform_seconds': round(pre_transform_seconds, 4),
+        'vega_bytes': len(json.dumps(vega_spec).encode('utf-8')),
+        'vega_inline_rows': count_inline_rows(vega_spec),
+        'layers': count_chart_layers(chart),
+    }
+    chart_profiles.append(profile)
+    profile_logger.info(json.dumps(profile))
+
+    return chart
+
+
+
+def to_shared_dataset(data, datasets):
+
+    # Altair data transformer: every chart table is serialized once to Arrow IPC (what Streamlit sends to the
+    # browser) and referenced by name, so that the spec can be reused as is by every session
+    data_bytes = dataframe_util.convert_anything_to_arrow_bytes(data)
+    name = hashlib.sha256(data_bytes).hexdigest()[:16]
+    datasets[name] = data_bytes
+
+    return {'name': name}
+
+
+
+def load_chart_runtime():
+
+    # first chart of the process: Altair is loaded here, with the VegaFusion pre-transform (used for the
+    # profiles and the exported Vega specs) and the transformer of the shared specs. Registering is idempotent
+    with ALTAIR_GLOBALS_LOCK:
+        alt.data_transformers.register('shared_datasets', to_shared_dataset)
+        alt.data_transformers.enable('vegafusion')
+
+
+
+def chart_to_shared_spec(chart):
+
+    # same Vega-Lite spec as st.altair_chart builds on every run (without the default theme sizes)
+    datasets = dict()
+    with ALTAIR_GLOBALS_LOCK, alt.data_transformers.enable('shared_datasets', datasets = datasets), alt.theme.enable('none'):
+        spec = chart.to_dict()
+
+    spec['datasets'] = {**spec.get('datasets', dict()), **datasets}
+
+    return spec
+
+
+
+def shared_spec_bytes(spec):
+
+    # size of the JSON spec (with any dataset the chart inlines itself) and of its Arrow datasets
+    arrow_datasets = {name: data for name, data in spec['datasets'].items() if isinstance(data, bytes)}
+    json_spec = {**spec, 'datasets': {name: data for name, data in spec['datasets'].items() if name not in arrow_datasets}}
+
+    return len(json.dumps(json_spec).encode('utf-8')), sum(len(data) for data in arrow_datasets.values())
+
+
+
+
+def dashboard_chart_builders(prepared_frames, chart_tables):
+
+    mass_shootings, mass_shootings_regions, state_month_counts, county_population, aggregation_cube = prepared_frames
+    (state_lookup, county_lookup), state_aggregates, region_year_rates = chart_tables
+    load_chart_runtime()
+
+    # in DASHBOARD_CHARTS order
+    return {
+        'second_question_slopechart': (second_question_slopechart, (region_year_rates,)),
+        'extra_question': (extra_question, (mass_shootings, state_lookup, county_lookup)),
+        'first_and_third_question': (first_and_third_question, (mass_shootings_regions, state_month_counts, mass_shootings, county_population, aggregation_cube, state_lookup, state_aggregates)),
+    }
+
+
+
+def read_artifact_specs(store_key):
+
+    # artifacts built for other inputs or another version of this file are ignored
+    manifest_path = os.path.join(ARTIFACTS_DIR, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest['store'] != store_key:
+        return None
+
+    return {chart_name: read_shared_spec(os.path.join(ARTIFACTS_DIR, 'specs'), chart_name) for chart_name in manifest['charts']}
+
+
+
+def build_shared_spec(build_function, args):
+
+    return chart_to_shared_spec(build_function(*args))
+
+
+
+def chart_process_pool(workers):
+
+    # building an Altair chart is pure Python and holds the GIL, so independent charts are built in parallel in
+    # worker processes. They are started by a fork server, not forked from the (multi-threaded) caller, which
+    # could leave a child waiting on a lock another thread held: they import the modules themselves and set up
+    # the chart runtime, the tasks are module-level functions and their arguments (the frames) are pickled to them
+    return ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('forkserver'), initializer = load_chart_runtime)
+
+
+
+def submit_chart_tasks(chart_tasks, workers = BUILD_WORKERS):
+
+    # the charts are built in the background and returned as futures, in the order of the tasks: one after the
+    # other on a thread, or in parallel in worker processes (a cold session then waits for the slowest chart only)
+    if workers < 2 or len(chart_tasks) < 2:
+        pool = ThreadPoolExecutor(max_workers = 1)
+    else:
+        pool = chart_process_pool(min(workers, len(chart_tasks)))
+
+    futures = {name: pool.submit(task_function, *args) for name, (task_function, args) in chart_tasks.items()}
+    pool.shutdown(wait = False) # the submitted tasks still run, the workers exit after the last one
+
+    return futures
+
+
+
+
+def shared_spec_path(spec_dir, chart_name):
+
+    return os.path.join(spec_dir, f'{chart_name}.spec.json')
+
+
+
+def write_shared_spec(spec_dir, chart_name, spec):
+
+    # plain data only (the store may be a shared folder, nothing read from it is executed): the Arrow datasets
+    # as .arrow files named by their content hash (shared by the charts drawing the same table) and the rest of
+    # the spec as JSON, written last: a chart is in the store once its JSON file is
+    os.makedirs(spec_dir, exist_ok = True)
+    arrow_datasets = [name for name, data in spec['datasets'].items() if isinstance(data, bytes)]
+    for name in arrow_datasets:
+        replace_file(os.path.join(spec_dir, f'{name}.arrow'), spec['datasets'][name])
+
+    json_spec = {**spec, 'datasets': {name: data for name, data in spec['datasets'].items() if name not in arrow_datasets}}
+    replace_file(shared_spec_path(spec_dir, chart_name), json.dumps({'spec': json_spec, 'arrow_datasets': arrow_datasets}).encode('utf-8'))
+
+
+
+def read_shared_spec(spec_dir, chart_name):
+
+    with open(shared_spec_path(spec_dir, chart_name)) as f:
+        stored = json.load(f)
+
+    spec = stored['spec']
+    for name in stored['arrow_datasets']:
+        with open(os.path.join(spec_dir, f'{name}.arrow'), 'rb') as f:
+            spec['datasets'][name] = f.read()
+
+    return spec
+
+
+
+def load_shared_spec(spec_dir, chart_name, build_function, args):
+
+    # spec stored by any process using the same store, or built and stored for the next ones. The chart specs
+    # of previous versions of this file are removed once a new one is stored and they are no longer used
+    try:
+        return read_shared_spec(spec_dir, chart_name)
+    except FileNotFoundError: # not stored yet, or pruned meanwhile
+        pass
+
+    spec = build_shared_spec(build_function, args)
+    write_shared_spec(spec_dir, chart_name, spec)
+    prune_store(os.path.dirname(spec_dir), os.path.basename(spec_dir), CHART_STORE_PATTERN)
+
+    return spec
+
+
+
+def completed_future(result):
+
+    future = Future()
+    future.set_result(result)
+
+    return future
+
+
+
+def chart_store_dir(mass_shootings_hash, county_population_hash):
+
+    # the chart specs also depend on the chart code of this file (named like CHART_STORE_PATTERN)
+    return os.path.join(store_dir(mass_shootings_hash, county_population_hash), f'charts-{file_content_hash(__file__)[:16]}')
+
+
+
+def chart_store_key(mass_shootings_hash, county_population_hash):
+
+    return os.path.relpath(chart_store_dir(mass_shootings_hash, county_population_hash), PREPARED_CACHE_DIR)
+
+
+
+@st.cache_resource(show_spinner = False)
+def load_dashboard_specs(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash):
+
+    # the chart specs (with their Arrow datasets) are built once per store and shared by every session and
+    # every process using the same store: the rendering of a session no longer builds any chart object.
+    # They are futures, so that each session shows every chart as soon as it is ready (and sessions arriving
+    # during a cold build wait for the same builds instead of starting their own)
+    cache_dir = chart_store_dir(mass_shootings_hash, county_population_hash)
+    artifact_specs = read_artifact_specs(chart_store_key(mass_shootings_hash, county_population_hash))
+    if artifact_specs is not None:
+        return {chart_name: completed_future(spec) for chart_name, spec in artifact_specs.items()}
+
+    # every spec already in the store: neither the data nor Altair are loaded. The store and its chart specs are
+    # marked as used, so that no other version prunes them while this process serves them (see prune_store)
+    try:
+        chart_specs = {chart_name: completed_future(read_shared_spec(cache_dir, chart_name)) for chart_name in DASHBOARD_CHARTS}
+    except FileNotFoundError: # not stored yet, or pruned meanwhile: built below
+        chart_specs = None
+    if chart_specs is not None:
+        touch_store(os.path.dirname(cache_dir))
+        touch_store(cache_dir)
+        return chart_specs
+
+    chart_builders = dashboard_chart_builders(
+        load_prepared_data(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash),
+        load_chart_tables(mass_shootings_path, county_population_path, mass_shootings_hash, county_population_hash)
+    )
+
+    return submit_chart_tasks({
+        chart_name: (load_shared_spec, (cache_dir, chart_name, build_function, args))
+        for chart_name, (build_function, args) in chart_builders.items()
+    })
+
+
+
+def show_chart(chart):
+
+    # charts still being built in the background are waited for here, once the sections before them are shown.
+    # A failed build is not kept in the cache for the next sessions, they build the charts again instead of
+    # raising the same error. Shared specs are rendered as they are, live charts (profiling) are converted by Streamlit
+    if isinstance(chart, Future):
+        if chart.exception() is not None:
+            load_dashboard_specs.clear()
+        chart = chart.result()
+
+
+    if isinstance(chart, dict):
+        st.vega_lite_chart(chart, width = 'stretch')
+    else:
+        st.altair_chart(chart, width = 'stretch')
+
+
+
 def main():
-    mass_shootings = pd.read_csv('MassShootings.csv')
-    county_population = pd.read_csv('CountyPopulation.csv')
+    mass_shootings_path, county_population_path = 'MassShootings.csv', 'CountyPopulation.csv'
 
-    mass_shootings, mass_shootings_regions, mass_shootings_states, county_population = general_data_preparation(mass_shootings, county_population)
+    input_hashes = input_file_hash(mass_shootings_path), input_file_hash(county_population_path)
 
     st.set_page_config(layout = 'wide')
     st.markdown('## Analysis of the evolution of Mass Shootings in the US')
     st.markdown('**Authors:** Raquel Jolis Carné and Martina Massana Massip')
 
-    Q1_linechart_final = first_and_third_question(mass_shootings_regions, mass_shootings_states, mass_shootings, county_population)
-    st.altair_chart(Q1_linechart_final,use_container_width=True)
+    debug_sidebar = PROFILE_MODE in ('1', 'debug') and st.query_params.get('debug') == '1'
+    chart_profiles = list() if debug_sidebar or PROFILE_MODE == '1' else None
+    if chart_profiles is not None and not profile_logger.handlers: # the script module is re-executed on every rerun
+        profile_logger.addHandler(logging.StreamHandler())
+        profile_logger.setLevel(logging.INFO)
+        profile_logger.propagate = False
+
+    if chart_profiles is None:
+        charts = load_dashboard_specs(mass_shootings_path, county_population_path, *input_hashes)
+    else: # profiling measures the live build of every chart
+        chart_builders = dashboard_chart_builders(
+            load_prepared_data(mass_shootings_path, county_population_path, *input_hashes),
+            load_chart_tables(mass_shootings_path, county_population_path, *input_hashes)
+        )
+        charts = {chart_name: profile_chart(chart_profiles, chart_name, build_function, *args) for chart_name, (build_function, args) in chart_builders.items()}
 
-    Q2_slopecharts_final = second_question_slopechart(mass_shootings_regions)
+    # the sections are laid out first and filled from the lightest chart: the slope charts and the county map
+    # are shown while the regional and state views are still being built
+    Q1_placeholder = st.empty()
+    Q1_placeholder.caption('Loading the regional and state views...')
 
     choro_scatter, _, slopecharts = st.columns([1, 0.01, 1.5]) 
+    with slopecharts:
+        show_chart(charts['second_question_slopechart'])
     with choro_scatter:
-        st.markdown( # customization of slider width
+        st.markdown( # customization of slider width (the year slider is bound inside the chart)
             """
             <style>
-            div[data-baseweb="slider"] {
+            .vega-bind input[type="range"] {
                 width: 550px; 
             }
         
@@ -550,11 +978,14 @@ def main():
             """,
             unsafe_allow_html=True
         )
-        Qextra_year_selection = st.slider('Date Year Selector: Analyze Mass Shooting Trends Over Time', min_value=2014, max_value=2023, step=1, value=2014)
-        Qextra_choro_scatter_final = extra_question(mass_shootings, county_population, Qextra_year_selection)
-        st.altair_chart(Qextra_choro_scatter_final, use_container_width=True)
-    with slopecharts:
-        st.altair_chart(Q2_slopecharts_final, use_container_width=True)
+        show_chart(charts['extra_question'])
+
+    with Q1_placeholder.container():
+        show_chart(charts['first_and_third_question'])
+
+    if debug_sidebar:
+        st.sidebar.markdown('### Chart profiles')
+        st.sidebar.dataframe(pd.DataFrame(chart_profiles), hide_index = True)
 
 
 
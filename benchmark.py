@@ -0,0 +1,153 @@
+# Benchmark of the data preparation and chart building pipeline on synthetic scale-ups of the inputs.
+#
+#   python benchmark.py --scales 1 10 100 1000
+#
+# Every scale multiplies the number of incidents of MassShootings.csv (same schema, resampled rows with
+# new ids, dates and jittered coordinates). An untimed warm-up pass over the smallest scale first absorbs the
+# one-time costs of the process (imports, VegaFusion runtime startup), so that every scale is comparable.
+# Each stage is timed and the peak resident memory of the process so far recorded after it: a process-lifetime
+# value, not a per-stage one (--trace-memory traces the peak Python allocations of every stage, at a large
+# time overhead). The results are appended as JSON lines to the output file so that runs can be compared over time.
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+import data_preparation
+import Jolis_Massana_FinalVisualization as dashboard
+
+START_DATE, END_DATE = pd.Timestamp('2014-01-01'), pd.Timestamp('2023-12-31')
+
+
+def generate_synthetic_inputs(scale, data_dir, seed = 0):
+
+    # generated files are kept so that every run of the same scale measures the same data
+    mass_shootings_path = os.path.join(data_dir, f'MassShootings_x{scale}.csv')
+    county_population_path = os.path.join(data_dir, 'CountyPopulation.csv')
+    if os.path.exists(mass_shootings_path) and os.path.exists(county_population_path):
+        return mass_shootings_path, county_population_path
+
+    os.makedirs(data_dir, exist_ok = True)
+    rng = np.random.default_rng(seed)
+    mass_shootings = pd.read_csv('MassShootings.csv')
+
+    synthetic = mass_shootings.iloc[rng.integers(0, len(mass_shootings), len(mass_shootings) * scale)].reset_index(drop = True)
+    synthetic['Incident ID'] = np.arange(1, len(synthetic) + 1)
+    days = rng.integers(0, (END_DATE - START_DATE).days + 1, len(synthetic))
+    synthetic['Incident Date'] = (START_DATE + pd.to_timedelta(days, unit = 'D')).strftime('%Y-%m-%dT00:00:00Z')
+    synthetic['Latitude'] = synthetic['Latitude'] + rng.normal(0, 0.01, len(synthetic))
+    synthetic['Longitude'] = synthetic['Longitude'] + rng.normal(0, 0.01, len(synthetic))
+
+    synthetic.to_csv(mass_shootings_path, index = False)
+    pd.read_csv('CountyPopulation.csv').to_csv(county_population_path, index = False) # counties do not scale with incidents
+
+    return mass_shootings_path, county_population_path
+
+
+def run_stage(results, run_info, scale, stage, function, *args, **kwargs):
+
+    # without a result list (warm-up), the stage is only run
+    if results is None:
+        return function(*args, **kwargs)
+
+    if run_info['trace_memory']:
+        tracemalloc.start()
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    result = {**run_info, 'scale': scale, 'stage': stage, 'seconds': round(seconds, 4)}
+    result['process_max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1) # kilobytes on Linux
+    if run_info['trace_memory']:
+        result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+
+    results.append(result)
+    print(f'x{scale:<6} {stage:<40} {seconds:>9.3f} s {result["process_max_rss_mb"]:>10.1f} MB (process peak)')
+
+    return output
+
+
+def benchmark_scale(results, run_info, scale, data_dir, skip_charts):
+
+    mass_shootings_path, county_population_path = generate_synthetic_inputs(scale, data_dir)
+
+    mass_shootings = run_stage(results, run_info, scale, 'read_csv MassShootings', pd.read_csv, mass_shootings_path)
+    county_population = run_stage(results, run_info, scale, 'read_csv CountyPopulation', pd.read_csv, county_population_path)
+
+    # the main stages of general_data_preparation one by one, then all of it (with the quality report). Without
+    # the county assignment cache, so that every run measures the spatial index
+    incidents, _ = run_stage(results, run_info, scale, 'parse_incidents', data_preparation.parse_incidents, mass_shootings.copy())
+    incidents['County FIPS'] = run_stage(results, run_info, scale, 'assign_incident_counties', data_preparation.assign_incident_counties, incidents)
+    aggregation_cube = run_stage(results, run_info, scale, 'build_aggregation_cube', data_preparation.build_aggregation_cube, incidents)
+    state_attributes = data_preparation.build_state_attributes(incidents)
+    state_month_counts = run_stage(results, run_info, scale, 'count_matrix state month', data_preparation.count_state_months, aggregation_cube, state_attributes)
+    run_stage(results, run_info, scale, 'expand_count_matrix state month', data_preparation.expand_count_matrix, state_month_counts, state_attributes)
+
+    mass_shootings, mass_shootings_regions, state_month_counts, county_population, aggregation_cube = run_stage(
+        results, run_info, scale, 'general_data_preparation', data_preparation.general_data_preparation, mass_shootings, county_population, quality_report = dict()
+    )
+    state_lookup, county_lookup = run_stage(results, run_info, scale, 'build_lookup_tables', data_preparation.build_lookup_tables, mass_shootings, county_population)
+    state_aggregates = run_stage(results, run_info, scale, 'build_state_aggregates', data_preparation.build_state_aggregates, mass_shootings)
+    population_table = run_stage(results, run_info, scale, 'build_population_table', data_preparation.build_population_table, mass_shootings, county_population)
+    region_year_rates = run_stage(results, run_info, scale, 'per_capita_rates region year', data_preparation.per_capita_rates, aggregation_cube, population_table, 'region', 'year')
+
+    if skip_charts:
+        return
+
+    chart_builders = dashboard.dashboard_chart_builders(
+        (mass_shootings, mass_shootings_regions, state_month_counts, county_population, aggregation_cube),
+        ((state_lookup, county_lookup), state_aggregates, region_year_rates)
+    )
+    for chart_name, (build_function, args) in chart_builders.items():
+        chart = run_stage(results, run_info, scale, f'{chart_name} build', build_function, *args)
+        run_stage(results, run_info, scale, f'{chart_name} pre-transform', chart.to_dict, format = 'vega')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the dashboard pipeline on synthetic scale-ups of the inputs.')
+    parser.add_argument('--scales', type = int, nargs = '+', default = [1, 10, 100, 1000], help = 'incident count multipliers')
+    parser.add_argument('--data-dir', default = 'benchmark_data', help = 'where the synthetic inputs are generated and reused')
+    parser.add_argument('--output', default = 'benchmark_results.jsonl', help = 'JSON lines file the results are appended to')
+    parser.add_argument('--skip-charts', action = 'store_true', help = 'only benchmark the data preparation stages')
+    parser.add_argument('--trace-memory', action = 'store_true', help = 'also trace the peak Python allocations of every stage')
+    args = parser.parse_args()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    run_info = {
+        'run_id': time.strftime('%Y%m%dT%H%M%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'trace_memory': args.trace_memory,
+    }
+
+    # the geometry is decoded and indexed once per process, before any timed stage
+    data_preparation.load_county_index()
+    data_preparation.load_geometry_fips()
+
+    benchmark_scale(None, run_info, min(args.scales), args.data_dir, args.skip_charts)
+
+    results = list()
+    for scale in args.scales:
+        benchmark_scale(results, run_info, scale, args.data_dir, args.skip_charts)
+
+    with open(args.output, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# Ahead-of-time build of the dashboard: runs the pipeline once and writes every chart as a static artifact.
+#
+#   python build_artifacts.py --output dist
+#
+# The output folder can be served as is by any static file server (python -m http.server --directory dist):
+#   index.html                      page with the three charts and the year slider
+#   vega-embed.js                   Vega / Vega-Lite / Vega-Embed bundle (no CDN needed)
+#   geometry/                       the TopoJSON files the charts fetch
+#   <chart>.vg.json                 Vega specs pre-transformed by VegaFusion (the aggregated data is inlined)
+#   extra_question-<year>.vg.json   one variant of the choropleth per year of the slider
+#   specs/                          Vega-Lite specs (JSON) and their Arrow datasets, rendered as is by the Streamlit app
+#   manifest.json                   store key (input hashes and code version) the artifacts were built for
+# The Streamlit app serves specs/ instead of building the charts whenever the manifest matches
+# its inputs (DASHBOARD_ARTIFACTS_DIR, dist by default).
+
+import argparse
+import json
+import os
+import shutil
+import altair as alt
+import vl_convert
+
+import data_preparation
+import Jolis_Massana_FinalVisualization as dashboard
+
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="UTF-8">
+  <title>Analysis of the evolution of Mass Shootings in the US</title>
+  <script src="vega-embed.js"></script>
+  <style>
+    body {{ font-family: sans-serif; margin: 2rem; }}
+    .row {{ display: flex; gap: 2rem; align-items: flex-start; }}
+    #year {{ width: 550px; }}
+  </style>
+</head>
+<body>
+  <h2>Analysis of the evolution of Mass Shootings in the US</h2>
+  <p><b>Authors:</b> Raquel Jolis Carné and Martina Massana Massip</p>
+  <div id="first_and_third_question"></div>
+  <div class="row">
+    <div>
+      <label>Date Year Selector: Analyze Mass Shooting Trends Over Time
+        <input id="year" type="range" min="{min_year}" max="{max_year}" step="1" value="{min_year}">
+        <span id="year_label">{min_year}</span>
+      </label>
+      <div id="extra_question"></div>
+    </div>
+    <div id="second_question_slopechart"></div>
+  </div>
+  <script>
+    const embed = (element, url) => vegaEmbed(element, url, {{ mode: 'vega', actions: false }}).catch(console.error);
+    embed('#first_and_third_question', 'first_and_third_question.vg.json');
+    embed('#second_question_slopechart', 'second_question_slopechart.vg.json');
+    const year = document.getElementById('year');
+    const showYear = () => {{
+      document.getElementById('year_label').textContent = year.value;
+      embed('#extra_question', `extra_question-${{year.value}}.vg.json`);
+    }};
+    year.addEventListener('change', showYear);
+    showYear();
+  </script>
+</body>
+</html>
+"""
+
+
+def write_json(output_dir, name, spec):
+
+    with open(os.path.join(output_dir, name), 'w') as f:
+        json.dump(spec, f, separators = (',', ':'))
+
+
+# the static page fetches the geometry next to it, for the charts drawing maps
+STATIC_GEOMETRY_URL = 'geometry'
+MAP_CHARTS = ['first_and_third_question', 'extra_question']
+
+
+def build_vega_spec(build_function, args, options):
+
+    return build_function(*args, **options).to_dict(format = 'vega')
+
+
+def static_page_options(chart_name):
+
+    return {'geometry_url': STATIC_GEOMETRY_URL} if chart_name in MAP_CHARTS else dict()
+
+
+def run_chart_tasks(chart_tasks, workers):
+
+    # in the same worker processes as the cold builds of the app (see chart_process_pool)
+    if workers < 2 or len(chart_tasks) < 2:
+        return {name: task_function(*args) for name, (task_function, args) in chart_tasks.items()}
+
+    with dashboard.chart_process_pool(min(workers, len(chart_tasks))) as pool:
+        futures = {name: pool.submit(task_function, *args) for name, (task_function, args) in chart_tasks.items()}
+
+        return {name: future.result() for name, future in futures.items()}
+
+
+def build_artifacts(mass_shootings_path, county_population_path, output_dir, workers):
+
+    input_hashes = dashboard.file_content_hash(mass_shootings_path), dashboard.file_content_hash(county_population_path)
+    prepared_frames = dashboard.load_prepared_data(mass_shootings_path, county_population_path, *input_hashes)
+    chart_tables = dashboard.load_chart_tables(mass_shootings_path, county_population_path, *input_hashes)
+    chart_builders = dashboard.dashboard_chart_builders(prepared_frames, chart_tables)
+    os.makedirs(output_dir, exist_ok = True)
+    if os.path.exists(os.path.join(output_dir, 'manifest.json')): # a previous build is not served while this one runs
+        os.remove(os.path.join(output_dir, 'manifest.json'))
+
+    # specs for the Streamlit app, which serves the geometry under its own static route
+    chart_specs = run_chart_tasks({chart_name: (dashboard.build_shared_spec, task) for chart_name, task in chart_builders.items()}, workers)
+    shutil.rmtree(os.path.join(output_dir, 'specs'), ignore_errors = True) # datasets of a previous build are not kept
+    for chart_name, spec in chart_specs.items():
+        dashboard.write_shared_spec(os.path.join(output_dir, 'specs'), chart_name, spec)
+
+    # specs for the static page
+    shutil.copytree(data_preparation.GEOMETRY_DIR, os.path.join(output_dir, STATIC_GEOMETRY_URL), dirs_exist_ok = True)
+
+    vega_tasks = {f'{chart_name}.vg.json': (build_vega_spec, (*chart_builders[chart_name], static_page_options(chart_name))) for chart_name in ['first_and_third_question', 'second_question_slopechart']}
+
+    # the slider of the static page loads one pre-transformed variant per year, with only the incidents of that year
+    mass_shootings = prepared_frames[0]
+    (state_lookup, county_lookup), _, _ = chart_tables
+    years = range(int(mass_shootings['Year'].min()), int(mass_shootings['Year'].max()) + 1)
+    for year in years:
+        vega_tasks[f'extra_question-{year}.vg.json'] = (build_vega_spec, (dashboard.extra_question, (mass_shootings[mass_shootings['Year'] == year], state_lookup, county_lookup, year), static_page_options('extra_question')))
+
+    for file_name, vega_spec in run_chart_tasks(vega_tasks, workers).items():
+        write_json(output_dir, file_name, vega_spec)
+
+    vl_version = '_'.join(alt.SCHEMA_VERSION.split('.')[:2])
+    with open(os.path.join(output_dir, 'vega-embed.js'), 'w') as f:
+        f.write(vl_convert.javascript_bundle(vl_version = vl_version))
+    with open(os.path.join(output_dir, 'index.html'), 'w') as f:
+        f.write(HTML_TEMPLATE.format(min_year = years.start, max_year = years.stop - 1))
+
+    # written last: the app only serves a folder whose build completed
+    manifest = {
+        'store': dashboard.chart_store_key(*input_hashes),
+        'charts': list(chart_builders),
+        'years': list(years),
+    }
+    write_json(output_dir, 'manifest.json', manifest)
+
+    print(f'Dashboard artifacts written to {output_dir} ({len(chart_builders)} charts, {len(years)} year variants).')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Export the dashboard charts as static Vega specs and HTML.')
+    parser.add_argument('--mass-shootings', default = 'MassShootings.csv')
+    parser.add_argument('--county-population', default = 'CountyPopulation.csv')
+    parser.add_argument('--output', default = 'dist', help = 'folder the artifacts are written to')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'processes building the charts concurrently (below 2 they are built one after the other)')
+    args = parser.parse_args()
+
+    build_artifacts(args.mass_shootings, args.county_population, args.output, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Rebuilds the bundled TopoJSON geometry store from the U.S. Census 2016 cartographic boundary
+# shapefiles (cb_2016_us_state_500k / cb_2016_us_county_500k, shipped in the plotly-geo package).
+# Only needed when the geometry has to be regenerated, the dashboard itself just reads the JSON files:
+#
+#   pip install plotly-geo pyshp topojson shapely
+#   python build_geometry.py
+
+import json
+import os
+import numpy as np
+import shapefile
+import topojson
+import _plotly_geo
+
+from county_index import decode_arcs
+
+# simplification tolerance (in degrees) of every detail level
+DETAIL_LEVELS = {'low': 0.05, 'medium': 0.01, 'high': 0.002}
+
+SHAPEFILES_DIR = os.path.join(os.path.dirname(_plotly_geo.__file__), 'package_data')
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'geometry')
+
+
+def read_features(name):
+
+    features = list()
+    for shape_record in shapefile.Reader(os.path.join(SHAPEFILES_DIR, name), encoding = 'latin-1').iterShapeRecords():
+        fips = int(shape_record.record['GEOID'])
+        if int(shape_record.record['STATEFP']) > 56: # erasing territories, they are not drawn by albersUsa
+            continue
+        features.append({'type': 'Feature', 'id': fips, 'properties': {}, 'geometry': shape_record.shape.__geo_interface__})
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def build_topology(feature_collection, object_name, tolerance):
+
+    topology = topojson.Topology(
+        feature_collection,
+        object_name = object_name,
+        prequantize = 1e5,
+        toposimplify = tolerance,
+        prevent_oversimplify = True
+    ).to_dict()
+
+    # properties are not used by the charts, only the FIPS id is looked up
+    for geometry in topology['objects'][object_name]['geometries']:
+        geometry.pop('properties', None)
+
+    rewind_polygons(topology, object_name)
+    check_winding(topology, object_name)
+
+    return topology
+
+
+def ring_points(ring, arcs):
+
+    # negative indexes are arcs in reverse order (~index)
+    return np.concatenate([arcs[index] if index >= 0 else arcs[~index][::-1] for index in ring])
+
+
+def signed_area(points):
+
+    # shoelace formula in longitude / latitude: negative for clockwise rings
+    x, y = points[:, 0], points[:, 1]
+
+    return (np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+
+def rewind_polygons(topology, object_name):
+
+    # the simplification shrinks small islands into slivers that may be wound the wrong way, which d3-geo
+    # (spherical polygons) draws as covering the whole globe: collapsed rings (fewer than 4 positions once
+    # closed, or an area below one quantization cell) are dropped, with their holes when they are exterior
+    # rings, and the others rewound as d3-geo expects them, exterior rings clockwise and holes counterclockwise
+    arcs = decode_arcs(topology)
+    min_ring_area = np.prod(topology['transform']['scale'])
+    for geometry in topology['objects'][object_name]['geometries']:
+        polygons = geometry['arcs'] if geometry['type'] == 'MultiPolygon' else [geometry['arcs']]
+
+        rewound = list()
+        for polygon in polygons:
+            rings = list()
+            for position, ring in enumerate(polygon):
+                points = ring_points(ring, arcs)
+                area = signed_area(points)
+                if len(np.unique(points, axis = 0)) < 3 or abs(area) < min_ring_area:
+                    if position == 0:
+                        break
+                    continue
+                if (area > 0) == (position == 0):
+                    ring = [~index for index in reversed(ring)]
+                rings.append(ring)
+            if rings:
+                rewound.append(rings)
+
+        if not rewound:
+            raise ValueError(f'{object_name} {geometry["id"]}: every polygon collapsed in the simplification')
+        geometry['type'], geometry['arcs'] = ('Polygon', rewound[0]) if len(rewound) == 1 else ('MultiPolygon', rewound)
+
+
+def check_winding(topology, object_name):
+
+    arcs = decode_arcs(topology)
+    for geometry in topology['objects'][object_name]['geometries']:
+        polygons = geometry['arcs'] if geometry['type'] == 'MultiPolygon' else [geometry['arcs']]
+        for polygon in polygons:
+            if signed_area(ring_points(polygon[0], arcs)) >= 0:
+                raise ValueError(f'{object_name} {geometry["id"]}: exterior ring not wound clockwise')
+
+
+def main():
+
+    states = read_features('cb_2016_us_state_500k')
+    counties = read_features('cb_2016_us_county_500k')
+
+    for detail, tolerance in DETAIL_LEVELS.items():
+        outputs = {
+            f'us-states-{detail}.json': build_topology(states, 'states', tolerance),
+            f'us-counties-{detail}.json': build_topology(counties, 'counties', tolerance),
+        }
+        for file_name, topology in outputs.items():
+            with open(os.path.join(OUTPUT_DIR, file_name), 'w') as f:
+                json.dump(topology, f, separators = (',', ':'))
+
+
+if __name__ == '__main__':
+    main()
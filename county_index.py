@@ -0,0 +1,105 @@
+# Point-in-polygon assignment of coordinates to counties, over the bundled county geometry (see build_geometry.py).
+#
+# The county rings of the TopoJSON are decoded once into arrays of edges and a regular grid (cells of
+# cell_degrees) indexes the counties whose bounding box overlaps each cell. Points are assigned in batch:
+# the points of a cell are only tested against the counties of that cell, with an even-odd ray casting
+# vectorized over points and edges. Points outside every county (e.g. offshore) get no FIPS.
+
+import json
+import numpy as np
+import pandas as pd
+
+GRID_CELL_DEGREES = 0.5
+POINTS_PER_BATCH = 4096
+
+
+def decode_arcs(topology):
+
+    # absolute longitude/latitude of every quantized, delta-encoded arc
+    scale, translate = np.array(topology['transform']['scale']), np.array(topology['transform']['translate'])
+
+    return [np.cumsum(np.array(arc, dtype = float), axis = 0) * scale + translate for arc in topology['arcs']]
+
+
+def ring_edges(ring, arcs):
+
+    # negative indexes are arcs in reverse order (~index)
+    points = np.concatenate([arcs[index] if index >= 0 else arcs[~index][::-1] for index in ring])
+
+    return np.hstack([points[:-1], points[1:]])
+
+
+def load_county_edges(topology_path, object_name = 'counties'):
+
+    with open(topology_path) as f:
+        topology = json.load(f)
+    arcs = decode_arcs(topology)
+
+    # all the rings of a county (holes and islands included) in a single (x0, y0, x1, y1) edge array
+    fips, edges = list(), list()
+    for geometry in topology['objects'][object_name]['geometries']:
+        polygons = geometry['arcs'] if geometry['type'] == 'MultiPolygon' else [geometry['arcs']]
+        edges.append(np.concatenate([ring_edges(ring, arcs) for polygon in polygons for ring in polygon]))
+        fips.append(int(geometry['id']))
+
+    return np.array(fips), edges
+
+
+def load_geometry_fips(topology_path, object_name):
+
+    # only the FIPS of the geometries, without decoding any arc
+    with open(topology_path) as f:
+        topology = json.load(f)
+
+    return np.array([int(geometry['id']) for geometry in topology['objects'][object_name]['geometries']])
+
+
+def build_grid_index(edges, cell_degrees = GRID_CELL_DEGREES):
+
+    # grid cell -> positions of the counties whose bounding box overlaps it
+    grid_index = dict()
+    for position, county_edges in enumerate(edges):
+        x, y = county_edges[:, [0, 2]], county_edges[:, [1, 3]]
+        columns = range(int(np.floor(x.min() / cell_degrees)), int(np.floor(x.max() / cell_degrees)) + 1)
+        rows = range(int(np.floor(y.min() / cell_degrees)), int(np.floor(y.max() / cell_degrees)) + 1)
+        for column in columns:
+            for row in rows:
+                grid_index.setdefault((column, row), list()).append(position)
+
+    return grid_index
+
+
+def points_in_polygon(longitudes, latitudes, edges):
+
+    # even-odd rule: a point is inside when a ray towards +x crosses an odd number of edges
+    x0, y0, x1, y1 = (edges[:, i] for i in range(4))
+    latitudes = latitudes[:, None]
+    crossing = (y0 > latitudes) != (y1 > latitudes)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        x_crossing = x0 + (latitudes - y0) * (x1 - x0) / (y1 - y0)
+
+    return (crossing & (longitudes[:, None] < x_crossing)).sum(axis = 1) % 2 == 1
+
+
+def assign_county_fips(longitudes, latitudes, fips, edges, grid_index, cell_degrees = GRID_CELL_DEGREES):
+
+    longitudes, latitudes = np.asarray(longitudes, dtype = float), np.asarray(latitudes, dtype = float)
+    assigned = np.zeros(len(longitudes), dtype = np.int64)
+    located = ~(np.isnan(longitudes) | np.isnan(latitudes))
+
+    cells = pd.DataFrame({
+        'column': np.floor(longitudes[located] / cell_degrees).astype(int),
+        'row': np.floor(latitudes[located] / cell_degrees).astype(int),
+        'point': np.flatnonzero(located)
+    })
+    for (column, row), cell_points in cells.groupby(['column', 'row'])['point']:
+        for start in range(0, len(cell_points), POINTS_PER_BATCH):
+            points = cell_points.to_numpy()[start:start + POINTS_PER_BATCH]
+            for position in grid_index.get((column, row), list()):
+                pending = points[assigned[points] == 0]
+                if len(pending) == 0:
+                    break
+                inside = points_in_polygon(longitudes[pending], latitudes[pending], edges[position])
+                assigned[pending[inside]] = fips[position]
+
+    return pd.array(np.where(assigned == 0, pd.NA, assigned), dtype = 'Int32')
@@ -0,0 +1,512 @@
+# Headless data preparation of the dashboard: from the input CSVs to the prepared frames, the aggregation
+# cube, the lookup tables and the per-capita rates. Only needs pandas (and pyarrow for the columnar store),
+# so batch jobs can use it without Streamlit nor Altair:
+#
+#   import data_preparation
+#   prepared_frames = data_preparation.prepare_data('MassShootings.csv', 'CountyPopulation.csv')
+#
+# The preparation also counts the rows it loses (coerced values, incidents without county or state attributes)
+# per column and per state, and the FIPS codes missing from the geometry: the report is stored next to the
+# prepared frames (data_quality.json, see read_quality_report) and its totals are logged when they are not zero.
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import pandas as pd
+import county_index
+
+try:
+    import pyarrow.feather as feather
+except ImportError: # the columnar cache of the prepared frames is optional
+    feather = None
+
+# bundled TopoJSON geometry (states and counties, at several simplification levels), see build_geometry.py.
+# The incidents are assigned to the counties of the most detailed level
+GEOMETRY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'geometry')
+STATE_GEOMETRY_PATH = os.path.join(GEOMETRY_DIR, 'us-states-high.json')
+COUNTY_GEOMETRY_PATH = os.path.join(GEOMETRY_DIR, 'us-counties-high.json')
+
+# prepared frames are persisted as uncompressed Feather (memory-mapped on reload), one folder per input hashes
+# and version of the preparation code and geometry (a change in them must not reuse frames prepared by the previous ones).
+# Server processes started with the same DASHBOARD_STORE_DIR (e.g. a folder in /dev/shm) share a single
+# read-only store
+PREPARED_CACHE_DIR = os.environ.get('DASHBOARD_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.prepared_cache'))
+
+# entries of PREPARED_CACHE_DIR replaced by a new version: stores of other inputs or code, county assignments
+# of another geometry. They are only removed once unused for STORE_RETENTION_SECONDS (see prune_store): a
+# process still running a previous version, e.g. during a rolling deploy, keeps its own store
+STORE_PATTERN = re.compile(r'[0-9a-f]{16}-[0-9a-f]{16}-[0-9a-f]+')
+COUNTY_ASSIGNMENTS_PATTERN = re.compile(r'county_assignments(-[0-9a-f]{16})?\.feather')
+PREPARED_FRAMES = ['mass_shootings', 'mass_shootings_regions', 'state_month_counts', 'county_population', 'aggregation_cube']
+STORE_RETENTION_SECONDS = float(os.environ.get('DASHBOARD_STORE_RETENTION_SECONDS', 24 * 60 * 60))
+CATEGORICAL_COLUMNS = ['State', 'Region', 'Abbreviation', 'City Or County']
+
+# time grains of the aggregation cube, with the period column of their roll-ups
+TIME_GRAINS = {'month': 'Month,Year', 'quarter': 'Quarter', 'year': 'Year'}
+
+# incident column every level of the per-capita rates is counted by
+RATE_KEYS = {'region': 'Region', 'state': 'FIPS', 'county': 'County FIPS'}
+
+# numeric incident columns whose unparsable values become NaN, counted in the data quality report
+COERCED_COLUMNS = ['Latitude', 'Longitude', 'FIPS']
+DATA_QUALITY_REPORT = 'data_quality.json'
+
+quality_logger = logging.getLogger('dashboard.data_quality')
+
+
+def count_matrix(frame, entity_column, period_column, periods, count_column = None):
+
+    # entities x periods integer matrix of row counts, or of the sum of count_column when the rows are
+    # already counts (periods without rows are zeros), built from the observed pairs only instead of
+    # crossing every entity with every period
+    groups = frame.groupby([entity_column, period_column], observed = True)
+    counts = (groups.size() if count_column is None else groups[count_column].sum()).unstack(period_column, fill_value = 0)
+
+    return counts.reindex(columns = pd.Index(periods, name = period_column), fill_value = 0).astype('int32')
+
+
+def expand_count_matrix(counts, entity_attributes, count_column = 'Total Shootings'):
+
+    # long form (one row per entity and period) with the entity attributes, only when a chart needs it
+    expanded = counts.stack().rename(count_column).reset_index()
+    expanded['Year'] = expanded[counts.columns.name].dt.year
+
+    return expanded.merge(entity_attributes, on = counts.index.name, how = 'inner')
+
+
+def build_aggregation_cube(mass_shootings):
+
+    # incident counts at the finest level of the dashboard (county and month, with the state and region of
+    # the incidents), the only pass over the incident table: every other count is rolled up from it
+    keys = ['Region', 'State', 'FIPS', 'County FIPS', 'Month,Year']
+
+    return mass_shootings.groupby(keys, observed = True, dropna = False).size().reset_index(name = 'Total Shootings')
+
+
+def grain_periods(months, grain):
+
+    if grain == 'year':
+        return months.dt.year
+    if grain == 'quarter':
+        return months.dt.to_period('Q').dt.to_timestamp()
+
+    return months
+
+
+def cube_rollup(aggregation_cube, levels, grain = None):
+
+    # counts summed up to the given levels (e.g. ['Region'] or ['County FIPS', 'State']), per time grain
+    # (month, quarter or year) or over the whole period. Missing levels (e.g. unassigned counties) are dropped
+    periods = list()
+    if grain is not None:
+        aggregation_cube = aggregation_cube.assign(**{TIME_GRAINS[grain]: grain_periods(aggregation_cube['Month,Year'], grain)})
+        periods = [TIME_GRAINS[grain]]
+
+    return aggregation_cube.groupby(levels + periods, observed = True)['Total Shootings'].sum().reset_index()
+
+
+@functools.cache
+def load_geometry_fips():
+
+    return (
+        county_index.load_geometry_fips(STATE_GEOMETRY_PATH, 'states'),
+        county_index.load_geometry_fips(COUNTY_GEOMETRY_PATH, 'counties')
+    )
+
+
+def fips_list(values):
+
+    return sorted(int(value) for value in values)
+
+
+def data_quality_report(mass_shootings, coerced, state_attributes, county_population, patched_counties, state_rows):
+
+    # one boolean flag per incident and issue, built from the masks of the preparation itself: a single
+    # groupby over the flags counts them per state, the inputs are not scanned again
+    county_fips = county_population['County FIPS']
+    located = mass_shootings['Latitude'].notna().to_numpy() & mass_shootings['Longitude'].notna().to_numpy()
+    assigned = mass_shootings['County FIPS'].notna().to_numpy()
+    flags = pd.DataFrame({f'{column.lower()}_coerced': mask for column, mask in coerced.items()})
+    flags['without_coordinates'] = ~located
+    flags['without_county'] = located & ~assigned
+    flags['county_without_population'] = assigned & ~mass_shootings['County FIPS'].isin(county_fips).to_numpy()
+    flags['without_region'] = mass_shootings['Region'].isna().to_numpy()
+    flags['dropped_state_attributes'] = ~mass_shootings['State'].isin(state_attributes['State']).to_numpy()
+
+    per_state = flags.groupby(mass_shootings['State'].fillna('(missing)').to_numpy()).sum()
+    per_state = per_state[per_state.any(axis = 1)]
+
+    state_geometry, county_geometry = load_geometry_fips()
+    incident_states = mass_shootings['FIPS'].dropna().unique()
+
+    return {
+        'incidents': len(mass_shootings),
+        'columns': {flag: int(count) for flag, count in per_state.sum().items()},
+        'states': {state: {flag: int(count) for flag, count in counts.items() if count} for state, counts in per_state.iterrows()},
+        'county_population': {
+            'counties': len(county_population),
+            'dropped_state_rows': state_rows,
+            'patched_counties': fips_list(patched_counties['County FIPS']),
+            'patched_counties_in_input': fips_list(county_fips[county_fips.duplicated() & county_fips.isin(patched_counties['County FIPS'])]),
+        },
+        'geometry': {
+            'incident_states_without_geometry': fips_list(set(incident_states) - set(state_geometry)),
+            'counties_without_geometry': fips_list(set(county_fips) - set(county_geometry)),
+            'geometry_counties_without_population': fips_list(set(county_geometry) - set(county_fips)),
+        },
+    }
+
+
+def parse_incidents(mass_shootings):
+
+    # unparsable values become NaN, the masks of the coerced values are returned for the quality report
+    coerced = dict()
+    for column in COERCED_COLUMNS:
+        parsed = pd.to_numeric(mass_shootings[column], errors='coerce')
+        coerced[column] = (parsed.isna() & mass_shootings[column].notna()).to_numpy()
+        mass_shootings[column] = parsed
+
+    mass_shootings['Incident Date'] = pd.to_datetime(mass_shootings['Incident Date'])
+    mass_shootings['Month,Year'] = mass_shootings['Incident Date'].dt.to_period('M').dt.to_timestamp()
+    mass_shootings['Year'] = mass_shootings['Month,Year'].dt.year
+
+    return mass_shootings.drop('Incident Date', axis=1), coerced
+
+
+def build_state_attributes(mass_shootings):
+
+    # one row per state with its attributes, the counts are kept apart from them
+    return mass_shootings[['State', 'State_Lon', 'State_Lat', 'Abbreviation', 'FIPS', 'Region', 'Population']].dropna().drop_duplicates('State')
+
+
+def count_state_months(aggregation_cube, state_attributes):
+
+    # continuous: every state has all the months, with 0 when there were no shootings
+    dates = pd.date_range(start = '2014-01', end = '2023-12', freq = 'MS')
+
+    return count_matrix(aggregation_cube[aggregation_cube['State'].isin(state_attributes['State'])], 'State', 'Month,Year', dates, 'Total Shootings')
+
+
+def general_data_preparation(mass_shootings, county_population, county_assignments_dir = None, quality_report = None):
+
+    # unparsable values become NaN, the quality report (filled when given) counts them. The county assignments
+    # are only cached in county_assignments_dir when given (prepare_data uses the store)
+    mass_shootings, coerced = parse_incidents(mass_shootings)
+    mass_shootings['County FIPS'] = assign_incident_counties(mass_shootings, county_assignments_dir)
+    state_attributes = build_state_attributes(mass_shootings)
+
+    aggregation_cube = build_aggregation_cube(mass_shootings)
+
+    # grouping BY REGION AND MONTH
+    mass_shootings_regions = cube_rollup(aggregation_cube, ['Region'], 'month')
+    mass_shootings_regions.insert(2, 'Year', mass_shootings_regions['Month,Year'].dt.year)
+    region_population = state_attributes.groupby(['Region'])['Population'].sum()
+    mass_shootings_regions = mass_shootings_regions.merge(region_population, on = 'Region')
+
+    # grouping BY STATE AND MONTH: kept as the states x months matrix, expanded by the charts (see expand_count_matrix)
+    state_month_counts = count_state_months(aggregation_cube, state_attributes)
+
+    # preparation of conty population
+    missing_counties = pd.DataFrame([
+        {'County FIPS': 2201, 'County Name': 'Prince of Wales-Outer Ketchikan, AK', 'County Population': 5696},
+        {'County FIPS': 2232, 'County Name': 'Skagway-Hoonah-Angoon, AK', 'County Population': 2262},
+        {'County FIPS': 2261, 'County Name': 'Valdez-Cordova, AK', 'County Population': 9202},
+        {'County FIPS': 2270, 'County Name': 'Wade Hampton, AK', 'County Population': 8001},
+        {'County FIPS': 2280, 'County Name': 'Wrangell-Petersburg, AK', 'County Population': 2064},
+        {'County FIPS': 46113, 'County Name': 'Shannon County, SD', 'County Population': 13672},
+        {'County FIPS': 51515, 'County Name': 'Bedford, VA', 'County Population': 6777},
+    ])
+    county_population = pd.concat([county_population, missing_counties], ignore_index=True)
+    state_rows = county_population['County FIPS']%1000 == 0
+    county_population = county_population[~state_rows] # erasing State FIPS
+
+    if quality_report is not None:
+        quality_report.update(data_quality_report(mass_shootings, coerced, state_attributes, county_population, missing_counties, int(state_rows.sum())))
+
+    return mass_shootings, mass_shootings_regions, state_month_counts, county_population, aggregation_cube
+
+
+def file_content_hash(path):
+
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def compact_dtypes(frame):
+
+    # repeated labels as categoricals and the smallest numeric types that hold the values. A count matrix
+    # (periods as columns) keeps its single integer type
+    if frame.columns.name is not None:
+        return frame
+
+    frame = frame.copy()
+    for column in frame.columns:
+        if column in CATEGORICAL_COLUMNS:
+            frame[column] = frame[column].astype('category')
+        elif pd.api.types.is_integer_dtype(frame[column]):
+            frame[column] = pd.to_numeric(frame[column], downcast = 'integer')
+        elif pd.api.types.is_float_dtype(frame[column]):
+            frame[column] = pd.to_numeric(frame[column], downcast = 'float')
+
+    return frame
+
+
+def replace_file(path, data):
+
+    # written aside and renamed, so that concurrent readers never see a partial file. The data are the bytes
+    # of the file, or a function writing them to the open file (a Feather table is not copied in memory first)
+    with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
+        if callable(data):
+            data(f)
+        else:
+            f.write(data)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+def read_prepared_frames(cache_dir):
+
+    if feather is None:
+        return None
+
+    try:
+        prepared_frames = tuple(feather.read_table(os.path.join(cache_dir, f'{name}.feather'), memory_map = True).to_pandas(split_blocks = True) for name in PREPARED_FRAMES)
+    except FileNotFoundError: # not written yet, or pruned meanwhile: prepared again
+        return None
+    touch_store(cache_dir)
+
+    return prepared_frames
+
+
+def write_prepared_frames(cache_dir, prepared_frames):
+
+    if feather is None:
+        return
+
+    os.makedirs(cache_dir, exist_ok = True)
+    for name, frame in zip(PREPARED_FRAMES, prepared_frames):
+        # a count matrix keeps its entity index (the period labels of its columns are restored from the pandas metadata)
+        frame = frame if frame.index.name is not None else frame.reset_index(drop = True)
+        replace_file(os.path.join(cache_dir, f'{name}.feather'), functools.partial(feather.write_feather, frame, compression = 'uncompressed'))
+
+
+def write_quality_report(cache_dir, quality_report):
+
+    os.makedirs(cache_dir, exist_ok = True)
+    path = os.path.join(cache_dir, DATA_QUALITY_REPORT)
+    replace_file(path, json.dumps(quality_report, indent = 2).encode('utf-8'))
+
+    losses = {flag: count for flag, count in quality_report['columns'].items() if count}
+    if losses:
+        quality_logger.warning('%d incidents, rows with data quality issues: %s (details in %s)', quality_report['incidents'], losses, path)
+
+
+def read_quality_report(mass_shootings_hash, county_population_hash):
+
+    path = os.path.join(store_dir(mass_shootings_hash, county_population_hash), DATA_QUALITY_REPORT)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+@functools.cache
+def geometry_hash(path):
+
+    # the bundled geometry only changes with the code, hashed once per process
+    return file_content_hash(path)
+
+
+def store_dir(mass_shootings_hash, county_population_hash):
+
+    code_version = ''.join(hash_value[:8] for hash_value in [
+        file_content_hash(__file__), file_content_hash(county_index.__file__), geometry_hash(COUNTY_GEOMETRY_PATH), geometry_hash(STATE_GEOMETRY_PATH)
+    ])
+
+    return os.path.join(PREPARED_CACHE_DIR, f'{mass_shootings_hash[:16]}-{county_population_hash[:16]}-{code_version}')
+
+
+def touch_store(path):
+
+    # the modification time of a store entry is its last use (see prune_store)
+    try:
+        os.utime(path)
+    except OSError: # read-only store, or pruned meanwhile
+        pass
+
+
+def prune_store(parent_dir, current_name, pattern, retention_seconds = STORE_RETENTION_SECONDS):
+
+    # entries replaced by the one just written would hold memory forever in a store under /dev/shm: they are
+    # removed once no process has used them for retention_seconds (readers of an entry touch it). Only the
+    # entries named like the pattern, the folder may hold other files
+    unused_since = time.time() - retention_seconds
+    for name in os.listdir(parent_dir):
+        if name == current_name or not pattern.fullmatch(name):
+            continue
+        path = os.path.join(parent_dir, name)
+        try:
+            if os.stat(path).st_mtime > unused_since:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors = True)
+            else:
+                os.remove(path)
+        except FileNotFoundError: # removed by another process meanwhile
+            pass
+
+
+@functools.cache
+def load_county_index():
+
+    # decoded and indexed once per process
+    fips, edges = county_index.load_county_edges(COUNTY_GEOMETRY_PATH)
+
+    return fips, edges, county_index.build_grid_index(edges)
+
+
+def assign_incident_counties(mass_shootings, cache_dir = None):
+
+    # County FIPS of every incident from its coordinates. Assignments are cached by Incident ID (with the
+    # coordinates they were computed from), so only new or moved incidents go through the spatial index,
+    # in one cache per county geometry: a regenerated geometry assigns every incident again
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f'county_assignments-{geometry_hash(COUNTY_GEOMETRY_PATH)[:16]}.feather')
+    incidents = mass_shootings[['Incident ID', 'Longitude', 'Latitude']].reset_index(drop = True)
+    cached = None
+    if cache_path is not None and feather is not None:
+        try:
+            cached = feather.read_feather(cache_path)
+            touch_store(cache_path)
+        except FileNotFoundError: # not written yet, or pruned meanwhile
+            pass
+    if cached is not None:
+        incidents = incidents.merge(cached, on = ['Incident ID', 'Longitude', 'Latitude'], how = 'left')
+    else:
+        incidents = incidents.assign(**{'County FIPS': None, 'Assigned': None})
+    incidents['County FIPS'] = incidents['County FIPS'].astype('Int32')
+
+    pending = incidents['Assigned'].isna()
+    if pending.any():
+        incidents.loc[pending, 'County FIPS'] = county_index.assign_county_fips(incidents.loc[pending, 'Longitude'], incidents.loc[pending, 'Latitude'], *load_county_index())
+        incidents['Assigned'] = True
+
+        if cache_path is not None and feather is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+            assignments = pd.concat([cached, incidents], ignore_index = True) if cached is not None else incidents
+            assignments = assignments.drop_duplicates('Incident ID', keep = 'last').reset_index(drop = True)
+            replace_file(cache_path, functools.partial(feather.write_feather, assignments, compression = 'uncompressed'))
+            prune_store(cache_dir, os.path.basename(cache_path), COUNTY_ASSIGNMENTS_PATTERN)
+
+    return incidents['County FIPS'].array
+
+
+def prepare_data(mass_shootings_path, county_population_path, mass_shootings_hash = None, county_population_hash = None):
+
+    # cold starts reuse the columnar store written by any previous process for the same inputs
+    # instead of parsing the CSVs again
+    if mass_shootings_hash is None:
+        mass_shootings_hash = file_content_hash(mass_shootings_path)
+    if county_population_hash is None:
+        county_population_hash = file_content_hash(county_population_path)
+
+    cache_dir = store_dir(mass_shootings_hash, county_population_hash)
+    prepared_frames = read_prepared_frames(cache_dir)
+    if prepared_frames is not None:
+        return prepared_frames
+
+    mass_shootings = pd.read_csv(mass_shootings_path)
+    county_population = pd.read_csv(county_population_path)
+
+    quality_report = dict()
+    prepared_frames = tuple(compact_dtypes(frame) for frame in general_data_preparation(mass_shootings, county_population, PREPARED_CACHE_DIR, quality_report = quality_report))
+    write_quality_report(cache_dir, quality_report) # before the frames: a store with frames always has its report
+    write_prepared_frames(cache_dir, prepared_frames)
+    prune_store(PREPARED_CACHE_DIR, os.path.basename(cache_dir), STORE_PATTERN)
+
+    return prepared_frames
+
+
+def build_lookup_tables(mass_shootings, county_population):
+
+    # one row per FIPS with only the looked-up columns: the choropleths join against these
+    # instead of the incident or the state-month tables
+    state_lookup = mass_shootings[['FIPS', 'Region', 'State']].dropna().drop_duplicates('FIPS')
+    state_lookup['FIPS'] = state_lookup['FIPS'].astype(int)
+
+    county_lookup = county_population[['County FIPS', 'County Name', 'County Population']].drop_duplicates('County FIPS')
+
+    return state_lookup.reset_index(drop = True), county_lookup.reset_index(drop = True)
+
+
+def build_state_aggregates(mass_shootings):
+
+    # per-state aggregates that no selection changes, computed here instead of sending every incident to Vega
+    state_bubbles = mass_shootings.groupby('State', observed = True).agg(
+        latitude = ('Latitude', 'mean'),
+        longitude = ('Longitude', 'mean'),
+        count = ('Latitude', 'size')
+    ).reset_index()
+    state_labels = mass_shootings[['State', 'Abbreviation', 'State_Lon', 'State_Lat']].drop_duplicates('State').reset_index(drop = True)
+
+    return state_bubbles, state_labels
+
+
+def build_population_table(mass_shootings, county_population):
+
+    # every population the rates are normalized by, indexed by FIPS: the states (FIPS below 100) and the
+    # counties of the prepared county table (missing counties patched in), each with its state and region
+    # (none for the counties outside the 50 states of the incidents, e.g. DC and Puerto Rico)
+    states = mass_shootings[['FIPS', 'State', 'Region', 'Population']].dropna().drop_duplicates('FIPS')
+    states = states.assign(FIPS = states['FIPS'].astype(int), Name = states['State'].astype(str), Level = 'state')
+    states['State FIPS'] = states['FIPS']
+
+    counties = county_population.rename(columns = {'County FIPS': 'FIPS', 'County Name': 'Name', 'County Population': 'Population'})
+    counties = counties.assign(FIPS = counties['FIPS'].astype(int), Level = 'county')
+    counties['State FIPS'] = counties['FIPS'] // 1000
+    counties = counties.merge(states[['State FIPS', 'State', 'Region']], on = 'State FIPS', how = 'left')
+
+    population_table = pd.concat([states, counties], ignore_index = True)[['FIPS', 'Level', 'Name', 'State FIPS', 'State', 'Region', 'Population']]
+
+    return population_table.drop_duplicates('FIPS').set_index('FIPS').sort_index()
+
+
+def level_population(population_table, level):
+
+    # population of every region (sum of its states), state or county, indexed like the incident column it joins
+    states = population_table[population_table['Level'] == 'state']
+    if level == 'region':
+        return states.groupby('Region', observed = True)['Population'].sum()
+    if level == 'state':
+        return states['Population']
+
+    return population_table.loc[population_table['Level'] == 'county', 'Population'].rename_axis('County FIPS')
+
+
+def per_capita_rates(aggregation_cube, population_table, level, grain = None, per = 10**7, rate_column = 'Shootings per 10M citizens'):
+
+    # shootings per `per` citizens of every region, state or county, over the whole period or per time grain
+    # of the aggregation cube. Counties are keyed by the County FIPS of the incidents. Dense like the counts of
+    # the charts: every entity with a population gets a rate for every period of the cube, 0 without incidents
+    key = RATE_KEYS[level]
+    population = level_population(population_table, level)
+    counts = cube_rollup(aggregation_cube, [key], grain)
+
+    if grain is None:
+        counts = counts.set_index(key)['Total Shootings'].reindex(population.index, fill_value = 0)
+    else:
+        months = pd.Series(pd.date_range(aggregation_cube['Month,Year'].min(), aggregation_cube['Month,Year'].max(), freq = 'MS'))
+        entity_periods = pd.MultiIndex.from_product([population.index, grain_periods(months, grain).unique()], names = [key, TIME_GRAINS[grain]])
+        counts = counts.set_index([key, TIME_GRAINS[grain]])['Total Shootings'].reindex(entity_periods, fill_value = 0)
+
+    rates = counts.reset_index().merge(population, left_on = key, right_index = True, how = 'inner')
+    rates[key] = rates[key].astype(aggregation_cube[key].dtype)
+    rates[rate_column] = rates['Total Shootings'] / rates['Population'] * per
+
+    return rates.reset_index(drop = True)
@@ -0,0 +1,91 @@
+# Incremental ingest of MassShootings_RAW.csv into the prepared MassShootings.csv used by the dashboard.
+#
+#   python ingest.py
+#
+# Only the RAW incidents whose Incident ID is not in the prepared file yet are parsed and appended: their
+# "December 31, 2017" dates are converted to ISO, the region and the state metadata (US_States_Metadata.csv)
+# are joined and the coordinates are taken from the local gazetteer cache, keyed by full address. The
+# gazetteer is seeded from the already prepared incidents; incidents whose address it does not know are
+# reported and left out, so they are retried on the next run once their coordinates have been added.
+
+import argparse
+import os
+import pandas as pd
+
+PREPARED_COLUMNS = [
+    'Incident ID', 'Incident Date', 'State', 'Population', 'FIPS', 'City Or County', 'Latitude', 'Longitude',
+    'Address', 'Region', 'Abbreviation', 'State_Lon', 'State_Lat'
+]
+
+
+def load_gazetteer(gazetteer_path, prepared_path):
+
+    if os.path.exists(gazetteer_path):
+        return pd.read_csv(gazetteer_path).drop_duplicates('Address')
+
+    gazetteer = pd.DataFrame(columns = ['Address', 'Latitude', 'Longitude'])
+    if os.path.exists(prepared_path):
+        gazetteer = pd.read_csv(prepared_path, usecols = ['Address', 'Latitude', 'Longitude']).drop_duplicates('Address')
+    gazetteer.to_csv(gazetteer_path, index = False)
+
+    return gazetteer
+
+
+def parse_raw_incidents(raw_incidents, states_regions, states_metadata):
+
+    incidents = raw_incidents[['Incident ID', 'Incident Date', 'State', 'City Or County', 'Address', 'Region']].copy()
+    incidents['Incident Date'] = pd.to_datetime(incidents['Incident Date'], format = '%B %d, %Y').dt.strftime('%Y-%m-%dT00:00:00Z')
+
+    # full address as written in the prepared file (and in the gazetteer): street (without its leading blanks), city and state
+    street = incidents['Address'].fillna('').str.lstrip()
+    incidents['Address'] = (street + ', ').where(street != '', '') + incidents['City Or County'] + ', ' + incidents['State']
+
+    # the regions file wins over the RAW column, which is only kept for states missing from it
+    incidents = incidents.merge(states_regions, on = 'State', how = 'left', suffixes = ('_raw', ''))
+    incidents['Region'] = incidents['Region'].fillna(incidents['Region_raw'])
+
+    return incidents.merge(states_metadata, on = 'State', how = 'inner')
+
+
+def ingest(raw_path, prepared_path, regions_path, metadata_path, gazetteer_path, full_rebuild = False):
+
+    raw_incidents = pd.read_csv(raw_path)
+
+    known_ids = set()
+    if os.path.exists(prepared_path) and not full_rebuild:
+        known_ids = set(pd.read_csv(prepared_path, usecols = ['Incident ID'])['Incident ID'])
+    new_incidents = raw_incidents[~raw_incidents['Incident ID'].isin(known_ids)].drop_duplicates('Incident ID')
+
+    if new_incidents.empty:
+        print('No new incidents.')
+        return
+
+    incidents = parse_raw_incidents(new_incidents, pd.read_csv(regions_path), pd.read_csv(metadata_path))
+    incidents = incidents.merge(load_gazetteer(gazetteer_path, prepared_path), on = 'Address', how = 'left')
+
+    unresolved = incidents[incidents['Latitude'].isna() | incidents['Longitude'].isna()]
+    incidents = incidents.drop(unresolved.index)[PREPARED_COLUMNS]
+
+    append = os.path.exists(prepared_path) and not full_rebuild
+    incidents.to_csv(prepared_path, mode = 'a' if append else 'w', header = not append, index = False)
+
+    print(f'{len(new_incidents)} new incidents: {len(incidents)} appended, '
+          f'{len(new_incidents) - len(incidents) - len(unresolved)} in states without metadata, {len(unresolved)} without coordinates in the gazetteer.')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Append the new RAW incidents to the prepared mass shootings file.')
+    parser.add_argument('--raw', default = 'MassShootings_RAW.csv')
+    parser.add_argument('--prepared', default = 'MassShootings.csv')
+    parser.add_argument('--regions', default = 'US_States_Regions.csv')
+    parser.add_argument('--states-metadata', default = 'US_States_Metadata.csv')
+    parser.add_argument('--gazetteer', default = 'Gazetteer.csv', help = 'Address, Latitude, Longitude cache')
+    parser.add_argument('--full-rebuild', action = 'store_true', help = 'rewrite the prepared file from every RAW incident')
+    args = parser.parse_args()
+
+    ingest(args.raw, args.prepared, args.regions, args.states_metadata, args.gazetteer, args.full_rebuild)
+
+
+if __name__ == '__main__':
+    main()